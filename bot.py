@@ -1,13 +1,29 @@
+import asyncio
 import logging
 import sqlite3
 import time
 import functools
-import requests
-import random
-import string
-import qrcode
+import collections
+import contextlib
+import concurrent.futures
+import queue
+import threading
+import secrets
+import segno
 import io
+import json
+import math
 import os
+import re
+import httpx
+import orjson
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter
+)
 
 from telegram import (
     Update,
@@ -18,76 +34,437 @@ from telegram import (
     KeyboardButton
 )
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackContext,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters
 )
-
-import pycountry_convert as pc
+from telegram.constants import ChatAction
 
 # === CONFIG ===
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 WALLET_ADDRESS = os.getenv("WALLET_ADDRESS")
 ESIM_API_KEY   = os.getenv("ESIM_API_KEY")  # RT-AccessCode
-ADMIN_IDS      = list(map(int, os.getenv("ADMIN_IDS","").split(",")))
+ADMIN_IDS      = frozenset(int(x) for x in os.getenv("ADMIN_IDS","").split(",") if x.strip())
+
+# === API ENDPOINTS ===
+TRONSCAN_API          = (
+    "https://apilist.tronscanapi.com/api/transaction"
+    "?sort=timestamp&count=true&limit=50&start=0&address="
+)
+TRONSCAN_WALLET_URL   = f"{TRONSCAN_API}{WALLET_ADDRESS}"
+USDT_TRC20_CONTRACT   = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+ESIM_API_BASE         = "https://api.esimaccess.com/api/v1/open"
+ESIM_PACKAGE_LIST_URL = f"{ESIM_API_BASE}/package/list"
+ESIM_ORDER_URL        = f"{ESIM_API_BASE}/esim/order"
+ESIM_QUERY_URL        = f"{ESIM_API_BASE}/esim/query"
 
 # === DATABASE SETUP ===
-conn = sqlite3.connect("esim_bot.db", check_same_thread=False)
-c    = conn.cursor()
-c.execute("""
-CREATE TABLE IF NOT EXISTS orders (
-  id         INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id    TEXT,
-  username   TEXT,
-  amount     REAL,
-  memo       TEXT,
-  plan_id    TEXT,
-  paid       INTEGER DEFAULT 0,
-  order_no   TEXT
+class DBPool:
+    """One dedicated writer plus a queue of read-only connections, all in WAL mode."""
+    def __init__(self, path: str, readers: int = 4):
+        self.path        = path
+        # Autocommit mode: write() issues BEGIN IMMEDIATE / COMMIT itself
+        self._writer     = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                                       cached_statements=256)
+        self._writer.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+        """)
+        self._tune(self._writer)
+        self._write_lock = threading.Lock()
+        self._readers    = queue.SimpleQueue()
+        for _ in range(readers):
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                                   cached_statements=256)
+            self._tune(conn)
+            self._readers.put(conn)
+
+    @staticmethod
+    def _tune(conn: sqlite3.Connection):
+        conn.executescript("""
+            PRAGMA busy_timeout=5000;
+            PRAGMA cache_size=-20000;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA foreign_keys=ON;
+        """)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Borrow a read-only connection for SELECTs."""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextlib.contextmanager
+    def write(self):
+        """Run the block in one BEGIN IMMEDIATE transaction on the single writer."""
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+pool = DBPool("esim_bot.db")
+
+SCHEMA = {
+    "orders": """
+        CREATE TABLE IF NOT EXISTS orders (
+          id         INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id    INTEGER,
+          username   TEXT,
+          amount     REAL,
+          memo       TEXT,
+          plan_id    TEXT,
+          paid       INTEGER DEFAULT 0,
+          order_no   TEXT,
+          created_at INTEGER
+        )
+    """,
+    "balances": """
+        CREATE TABLE IF NOT EXISTS balances (
+          user_id       INTEGER PRIMARY KEY,
+          balance_cents INTEGER NOT NULL DEFAULT 0
+        )
+    """,
+    "payments": """
+        CREATE TABLE IF NOT EXISTS payments (
+          tx_hash      TEXT PRIMARY KEY,
+          memo         TEXT NOT NULL,
+          amount_cents INTEGER NOT NULL,
+          ts           INTEGER NOT NULL
+        )
+    """,
+    "uncertain_orders": """
+        CREATE TABLE IF NOT EXISTS uncertain_orders (
+          memo       TEXT    PRIMARY KEY,
+          user_id    INTEGER NOT NULL,
+          plan_id    TEXT    NOT NULL,
+          cents      INTEGER NOT NULL,
+          error      TEXT,
+          created_at INTEGER NOT NULL
+        )
+    """,
+    "choices": """
+        CREATE TABLE IF NOT EXISTS choices (
+          id    INTEGER PRIMARY KEY,
+          code  TEXT    NOT NULL,
+          cents INTEGER NOT NULL,
+          UNIQUE (code, cents)
+        )
+    """,
+    "stats": """
+        CREATE TABLE IF NOT EXISTS stats (
+          id      INTEGER PRIMARY KEY CHECK (id = 1),
+          sold    INTEGER NOT NULL,
+          revenue REAL    NOT NULL,
+          users   INTEGER NOT NULL
+        )
+    """,
+}
+
+def init_schema():
+    with pool.write() as conn:
+        for ddl in SCHEMA.values():
+            conn.execute(ddl)
+        # Pre-cents databases keep the legacy REAL column; carry it over once
+        cols = {row[1] for row in conn.execute("PRAGMA table_info(balances)")}
+        if "balance_cents" not in cols:
+            conn.execute("ALTER TABLE balances ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE balances SET balance_cents = CAST(ROUND(balance * 100) AS INTEGER)")
+        # Orders from before created_at stay NULL and count as expired
+        cols = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+        if "created_at" not in cols:
+            conn.execute("ALTER TABLE orders ADD COLUMN created_at INTEGER")
+        # Older databases keyed users as TEXT; rebuild those tables with INTEGER ids
+        for table in ("orders", "balances"):
+            ddl   = SCHEMA[table]
+            types = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if types["user_id"].upper() != "INTEGER":
+                conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+                conn.execute(ddl)
+                new  = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+                cols = ",".join(new)
+                sel  = ",".join("CAST(user_id AS INTEGER)" if c == "user_id" else c for c in new)
+                conn.execute(f"INSERT INTO {table} ({cols}) SELECT {sel} FROM {table}_old")
+                conn.execute(f"DROP TABLE {table}_old")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_paid_user ON orders(paid, user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_paid ON orders(user_id, paid)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_paid_created ON orders(paid, created_at)")
+        # Older rows may share a memo copied onto several orders; keep it on the first only
+        conn.execute("""
+        UPDATE orders SET memo=NULL
+        WHERE memo IS NOT NULL
+          AND id NOT IN (SELECT MIN(id) FROM orders WHERE memo IS NOT NULL GROUP BY memo)
+        """)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_memo ON orders(memo)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_memo ON payments(memo)")
+        # /admin reads one counters row; place_order counts each sale as its
+        # order number comes back. Recount it from history at startup so older
+        # databases, whose totals also counted wallet deposits, are corrected.
+        conn.execute("""
+        INSERT OR REPLACE INTO stats (id, sold, revenue, users)
+        SELECT 1,
+               COUNT(*) FILTER (WHERE order_no IS NOT NULL),
+               COALESCE(SUM(amount) FILTER (WHERE order_no IS NOT NULL), 0),
+               COUNT(DISTINCT user_id)
+        FROM orders
+        """)
+        # paid=1 means "deposit received", which is not a sale
+        conn.execute("DROP TRIGGER IF EXISTS trg_stats_paid")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_user
+        AFTER INSERT ON orders
+        WHEN NOT EXISTS (SELECT 1 FROM orders WHERE user_id=NEW.user_id AND id<NEW.id)
+        BEGIN
+          UPDATE stats SET users=users+1 WHERE id=1;
+        END
+        """)
+
+init_schema()
+
+# Hot statements kept as module constants so sqlite3's per-connection statement cache hits
+SQL_INSERT_ORDER = (
+    "INSERT INTO orders (user_id,username,amount,memo,plan_id,created_at) "
+    "VALUES(?,?,?,?,?,CAST(strftime('%s','now') AS INTEGER))"
+)
+# Only a deposit that has already arrived can be linked; an unpaid row's memo
+# is still the one the user was told to pay with
+SQL_UPDATE_ORDER_PAID = """
+  UPDATE orders SET order_no=?
+  WHERE id = (SELECT id FROM orders
+              WHERE user_id=? AND plan_id=? AND paid=1 AND order_no IS NULL
+              ORDER BY id DESC LIMIT 1)
+"""
+SQL_INSERT_SALE    = (
+    "INSERT INTO orders (user_id,username,amount,memo,plan_id,paid,order_no,created_at) "
+    "VALUES(?,?,?,?,?,1,?,CAST(strftime('%s','now') AS INTEGER))"
+)
+SQL_COUNT_SALE     = "UPDATE stats SET sold=sold+1, revenue=revenue+? WHERE id=1"
+SQL_UPSERT_BALANCE = (
+    "INSERT INTO balances(user_id,balance_cents) VALUES(?,?) "
+    "ON CONFLICT(user_id) DO UPDATE SET balance_cents=balance_cents+excluded.balance_cents "
+    "RETURNING balance_cents"
+)
+SQL_GET_BALANCE    = "SELECT balance_cents FROM balances WHERE user_id=?"
+SQL_ALL_BALANCES   = "SELECT user_id, balance_cents FROM balances"
+SQL_DEBIT_BALANCE  = (
+    "UPDATE balances SET balance_cents=balance_cents-? "
+    "WHERE user_id=? AND balance_cents>=? RETURNING balance_cents"
 )
-""")
-c.execute("""
-CREATE TABLE IF NOT EXISTS balances (
-  user_id TEXT PRIMARY KEY,
-  balance REAL DEFAULT 0
+SQL_MARK_PAID      = "UPDATE orders SET paid=1 WHERE id=? AND paid=0"
+SQL_UNPAID_MEMOS   = (
+    "SELECT memo FROM orders WHERE paid=0 AND memo IS NOT NULL AND created_at>=?"
+)
+# Whatever arrived under a memo is credited, even if it isn't the amount asked for
+SQL_PAID_ORDERS    = """
+  SELECT o.id, o.user_id, SUM(p.amount_cents), CAST(ROUND(o.amount * 100) AS INTEGER)
+  FROM orders o
+  JOIN payments p ON p.memo = o.memo
+  WHERE o.paid=0
+  GROUP BY o.id
+"""
+SQL_INSERT_PAYMENT = "INSERT OR IGNORE INTO payments (tx_hash,memo,amount_cents,ts) VALUES(?,?,?,?)"
+SQL_LAST_PAYMENT   = "SELECT MAX(ts) FROM payments"
+SQL_LAST_PLAN      = (
+    "SELECT plan_id FROM orders WHERE user_id=? AND order_no IS NOT NULL ORDER BY id DESC LIMIT 1"
+)
+SQL_LAST_ORDER_NO  = (
+    "SELECT order_no FROM orders WHERE user_id=? AND paid=1 AND order_no IS NOT NULL "
+    "ORDER BY id DESC LIMIT 1"
+)
+SQL_SALES_REPORT   = "SELECT sold, revenue, users FROM stats WHERE id=1"
+SQL_FLAG_UNCERTAIN = (
+    "INSERT INTO uncertain_orders (memo,user_id,plan_id,cents,error,created_at) "
+    "VALUES(?,?,?,?,?,CAST(strftime('%s','now') AS INTEGER))"
+)
+SQL_NUM_UNCERTAIN  = "SELECT COUNT(*) FROM uncertain_orders"
+SQL_ALL_CHOICES    = "SELECT id, code, cents FROM choices"
+SQL_UPSERT_CHOICE  = (
+    "INSERT INTO choices (code,cents) VALUES(?,?) "
+    "ON CONFLICT(code,cents) DO UPDATE SET code=excluded.code RETURNING id"
 )
-""")
-conn.commit()
 
 # === LOGGING ===
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # === TTL CACHE DECORATOR ===
-def ttl_cache(ttl_seconds: int):
-    """Decorator to cache function results for a given TTL."""
+def ttl_cache(ttl_seconds: int, maxsize: int = 256):
+    """Decorator to cache a coroutine function's results for a given TTL.
+
+    An empty result (the API wrappers' failure value) never replaces a cached
+    one: the stale entry is served again and re-stamped until the next expiry.
+    At most maxsize keys are kept, least recently used evicted first.
+    """
     def decorator(fn):
-        cache = {}
-        @functools.wraps(fn)
-        def wrapped(*args, **kwargs):
+        cache    = collections.OrderedDict()
+        lock     = threading.Lock()
+        inflight = {}
+        def store(key, result, age: float = 0.0):
+            with lock:
+                entry = cache.get(key)
+                if not result and entry:
+                    result = entry[1]
+                cache[key] = (time.monotonic() - age, result)
+                cache.move_to_end(key)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+        def lookup(args, kwargs):
             key = (args, tuple(sorted(kwargs.items())))
-            entry = cache.get(key)
-            now = time.time()
-            if entry and now - entry[0] < ttl_seconds:
+            with lock:
+                entry = cache.get(key)
+                if entry and time.monotonic() - entry[0] < ttl_seconds:
+                    cache.move_to_end(key)
+                    return key, entry
+            return key, None
+        @functools.wraps(fn)
+        async def wrapped(*args, **kwargs):
+            key, entry = lookup(args, kwargs)
+            if entry:
                 return entry[1]
-            result = fn(*args, **kwargs)
-            cache[key] = (now, result)
+            # Concurrent misses for one key share a single upstream call
+            task = inflight.get(key)
+            if task is None:
+                task = inflight[key] = asyncio.ensure_future(fn(*args, **kwargs))
+                task.add_done_callback(lambda _: inflight.pop(key, None))
+            return store(key, await asyncio.shield(task))
+        async def refresh(*args, **kwargs):
+            """Recompute the entry regardless of its age; returns the fresh result."""
+            result = await fn(*args, **kwargs)
+            store((args, tuple(sorted(kwargs.items()))), result)
             return result
+        def prime(result, *args, age: float = 0.0, **kwargs):
+            """Seed an entry computed elsewhere (e.g. loaded from disk), age seconds old."""
+            store((args, tuple(sorted(kwargs.items()))), result, age)
+        wrapped.refresh = refresh
+        wrapped.prime = prime
         wrapped.clear_cache = lambda: cache.clear()
         return wrapped
     return decorator
 
 # === CONTINENT MAPPING ===
+# Static ISO2 -> continent table, shipped with the bot and loaded once
+_C2C_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "country_continent.json")
+with open(_C2C_PATH) as f:
+    COUNTRY_TO_CONTINENT: dict[str, str] = json.load(f)
+
 def country_to_continent(alpha2: str) -> str:
     """Convert ISO2 code to continent name; fallback to 'Other'."""
+    return COUNTRY_TO_CONTINENT.get(alpha2.upper(), "Other")
+
+# === HTTP SESSION ===
+# Shared pooled HTTP/2 client for async API calls; opened in post_init
+http_client: httpx.AsyncClient | None = None
+
+_purchase_tasks: list[asyncio.Task] = []
+
+async def _post_init(application):
+    global http_client
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(3.0, connect=1.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+    await asyncio.to_thread(warm_balance_cache)
+    _purchase_tasks[:] = [asyncio.create_task(purchase_worker(application)) for _ in range(PURCHASE_WORKERS)]
+
+PURCHASE_DRAIN_TIMEOUT = 20  # seconds; covers one order request
+
+async def _post_shutdown(application):
+    # Queued jobs were debited but never placed; refund them, then give the
+    # orders already in flight a chance to finish before cancelling workers
+    while not purchase_jobs.empty():
+        job = purchase_jobs.get_nowait()
+        credit_balance(job["user_id"], job["price"])
+        logger.info("refunded queued %s for %s on shutdown", job["code"], job["user_id"])
+        purchase_jobs.task_done()
+    try:
+        await asyncio.wait_for(purchase_jobs.join(), PURCHASE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("purchase workers still busy at shutdown")
+    for task in _purchase_tasks:
+        task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+    qr_executor.shutdown(wait=False)
+
+# === RETRIES & CIRCUIT BREAKERS ===
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that keeps failing."""
+
+class CircuitBreaker:
+    """Open after `threshold` consecutive failures; retry after `cooldown` seconds."""
+    def __init__(self, name: str, threshold: int = 5, cooldown: float = 30.0):
+        self.name      = name
+        self.threshold = threshold
+        self.cooldown  = cooldown
+        self.failures  = 0
+        self.opened_at = 0.0
+
+    def is_open(self) -> bool:
+        return (self.failures >= self.threshold
+                and time.monotonic() - self.opened_at < self.cooldown)
+
+    def record(self, ok: bool):
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            logger.warning("%s circuit open for %.0fs", self.name, self.cooldown)
+
+tron_breaker = CircuitBreaker("tronscan")
+esim_breaker = CircuitBreaker("esimaccess")
+
+# Throttling and server-side failures are worth another try; other 4xx are not
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def _retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUSES
+    return isinstance(exc, httpx.TransportError)
+
+async def http_request(breaker: CircuitBreaker, method: str, url: str,
+                       retry_on=None, **kwargs) -> httpx.Response:
+    """Send a request with jittered retries, counted against breaker.
+
+    By default transport errors and RETRY_STATUSES are retried; pass exception
+    types in retry_on to narrow that (e.g. for non-idempotent calls).
+    """
+    if breaker.is_open():
+        raise CircuitOpenError(breaker.name)
     try:
-        code = pc.country_alpha2_to_continent_code(alpha2)
-        return pc.convert_continent_code_to_continent_name(code)
-    except Exception:
-        return "Other"
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(3),
+            wait=wait_exponential_jitter(initial=0.1, max=1.0),
+            retry=(retry_if_exception_type(retry_on) if retry_on
+                   else retry_if_exception(_retryable)),
+            reraise=True
+        ):
+            with attempt:
+                r = await http_client.request(method, url, **kwargs)
+                r.raise_for_status()
+    except Exception as e:
+        # A 4xx is our request's fault (often user input), not an upstream outage
+        if _retryable(e):
+            breaker.record(False)
+        raise
+    breaker.record(True)
+    return r
 
 # === COMMON HEADERS FOR OPEN API ===
 COMMON_HEADERS = {
@@ -96,45 +473,196 @@ COMMON_HEADERS = {
 }
 
 # === UTILITIES ===
+# Money is carried as integer cents and only formatted at display time
+MIN_ORDER_CENTS  = 500
+MAX_AMOUNT_CENTS = 10_000_000  # 100k USDT; keeps typed amounts inside SQLite's INTEGER
+
+def to_cents(usd: float) -> int:
+    return round(usd * 100)
+
+def parse_usd(text: str) -> int | None:
+    """User-typed USD amount as positive cents; None if it isn't one."""
+    try:
+        usd = float(text)
+    except ValueError:
+        return None
+    if not math.isfinite(usd):
+        return None
+    cents = to_cents(usd)
+    return cents if 0 < cents <= MAX_AMOUNT_CENTS else None
+
+def fmt_usd(cents: int) -> str:
+    return f"{cents / 100:.2f}"
+
 def generate_memo() -> str:
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=12))
+    return secrets.token_hex(6).upper()
 
-def send_qr_code(text: str) -> InputFile:
-    qr = qrcode.make(text)
+@functools.lru_cache(maxsize=512)
+def _qr_png(text: str) -> bytes:
+    """Render text as a QR code and return the PNG bytes."""
     bio = io.BytesIO()
+    # make_qr never falls back to Micro QR, which most phone scanners can't read
+    segno.make_qr(text, error="l").save(bio, kind="png", scale=6)
+    return bio.getvalue()
+
+# QR rendering is CPU-bound; keep it off the event loop
+qr_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+async def send_qr_code(text: str) -> InputFile:
+    png = await asyncio.get_running_loop().run_in_executor(qr_executor, _qr_png, text)
+    bio = io.BytesIO(png)
     bio.name = "qrcode.png"
-    qr.save(bio, "PNG")
-    bio.seek(0)
     return InputFile(bio, filename="qrcode.png")
 
-def check_tron_payment(memo: str, expected: float) -> float:
-    url = (
-        f"https://apilist.tronscanapi.com/api/transaction"
-        f"?sort=-timestamp&count=true&limit=20&start=0&address={WALLET_ADDRESS}"
-    )
+# The payment QR only encodes the wallet address; amount and memo go in the caption.
+# After the first upload Telegram serves it back by file_id.
+_wallet_qr_file_id: str | None = None
+
+async def send_payment_request(message, caption: str):
+    global _wallet_qr_file_id
+    photo = _wallet_qr_file_id or await send_qr_code(WALLET_ADDRESS)
+    sent  = await message.reply_photo(photo=photo, caption=caption, parse_mode="Markdown")
+    if _wallet_qr_file_id is None:
+        _wallet_qr_file_id = sent.photo[-1].file_id
+    return sent
+
+# === BALANCE CACHE ===
+# Write-through: writers store the balance their statement returned while still
+# holding the write lock, so cache updates land in commit order even when one
+# writer runs in a worker thread
+balance_cache: dict[int, int] = {}
+
+def warm_balance_cache():
+    with pool.acquire() as conn:
+        balance_cache.update(conn.execute(SQL_ALL_BALANCES))
+
+def get_balance(uid: int) -> int:
+    """Balance in cents."""
+    bal = balance_cache.get(uid)
+    if bal is None:
+        with pool.acquire() as conn:
+            row = conn.execute(SQL_GET_BALANCE, (uid,)).fetchone()
+        bal = balance_cache[uid] = row[0] if row else 0
+    return bal
+
+def debit_balance(uid: int, cents: int) -> bool:
+    """Atomically take cents from uid's balance; False if it doesn't cover them."""
+    with pool.write() as conn:
+        row = conn.execute(SQL_DEBIT_BALANCE, (cents, uid, cents)).fetchone()
+        if row is None:
+            return False
+        balance_cache[uid] = row[0]
+    return True
+
+def credit_balance(uid: int, cents: int) -> int:
+    """Add cents to uid's balance; returns the new balance."""
+    with pool.write() as conn:
+        bal = balance_cache[uid] = conn.execute(SQL_UPSERT_BALANCE, (uid, cents)).fetchone()[0]
+    return bal
+
+# === TRON PAYMENT POLLER ===
+# One Tronscan fetch per interval records memo payments in the payments table;
+# every tick then credits whatever stored payment still has an unpaid order
+TRON_POLL_INTERVAL = 10  # seconds
+PAYMENT_WINDOW     = 86_400  # seconds an unpaid memo is watched for
+_MEMO_RE           = re.compile(r"\b[A-Z0-9]{12}\b")
+_tron_cursor: int | None = None  # ms timestamp of the newest transfer seen
+
+async def fetch_tron_payments() -> list[tuple[str, str, int, int]]:
+    """Page forward through the wallet's transfers; payment rows for unpaid memos."""
+    global _tron_cursor
+    now_ms = int(time.time() * 1000)
+    with pool.acquire() as conn:
+        since  = now_ms // 1000 - PAYMENT_WINDOW
+        unpaid = {memo for memo, in conn.execute(SQL_UNPAID_MEMOS, (since,))}
+        if _tron_cursor is None:
+            # Resume from the last stored payment, but never further back than
+            # the payment window; older memos aren't watched anyway
+            last = conn.execute(SQL_LAST_PAYMENT).fetchone()[0] or 0
+            _tron_cursor = max(last, now_ms - PAYMENT_WINDOW * 1000)
+    if not unpaid:
+        # Nothing can match; skip the request and move the cursor up (with a
+        # minute of slack for clock skew against block timestamps)
+        _tron_cursor = max(_tron_cursor, now_ms - 60_000)
+        return []
     try:
-        data = requests.get(url, timeout=5).json()
-        for tx in data.get("data", []):
-            if tx.get("data") and memo in tx["data"]:
-                amt = float(tx["tokenTransferInfo"]["amount_str"]) / 1e6
-                if abs(amt - expected) < 0.01:
-                    return amt
+        r = await http_request(tron_breaker, "GET", TRONSCAN_WALLET_URL,
+                               params={"start_timestamp": _tron_cursor})
+    except CircuitOpenError:
+        return []
     except Exception as e:
         logger.error(f"TRON check error: {e}")
-    return 0.0
+        return []
+    txs = orjson.loads(r.content).get("data", [])
+    rows, pending = [], []
+    for tx in txs:
+        m    = _MEMO_RE.search(tx.get("data") or "")
+        info = tx.get("tokenTransferInfo")
+        if not (m and info and m.group() in unpaid
+                and info.get("contract_address") == USDT_TRC20_CONTRACT
+                and info.get("to_address") == WALLET_ADDRESS):
+            continue
+        if not tx.get("confirmed"):
+            # Seen before it's final; fetch it again on later ticks
+            pending.append(tx["timestamp"])
+        elif tx.get("contractRet") == "SUCCESS":
+            # amount_str is in USDT base units (6 decimals)
+            rows.append((tx["hash"], m.group(), int(info["amount_str"]) // 10_000, tx["timestamp"]))
+    if txs:
+        # start_timestamp is inclusive; the tx_hash key drops the repeat.
+        # Never pass an unconfirmed payment, or it would drop out of the window.
+        newest       = max(tx["timestamp"] for tx in txs)
+        _tron_cursor = max(_tron_cursor, min([newest, *pending]))
+    return rows
+
+def settle_payments(rows: list[tuple[str, str, int, int]]) -> dict[int, int]:
+    """Store new payment rows and credit every unpaid order with a stored payment.
+
+    Runs in one transaction, so a payment is never stored without its credit;
+    anything left unsettled by a crash is picked up on the next call.
+    Returns {user_id: cents credited}.
+    """
+    if not rows:
+        with pool.acquire() as conn:
+            if conn.execute(SQL_PAID_ORDERS).fetchone() is None:
+                return {}
+    credited: dict[int, int] = {}
+    with pool.write() as conn:
+        conn.executemany(SQL_INSERT_PAYMENT, rows)
+        for oid, uid, amt, asked in conn.execute(SQL_PAID_ORDERS).fetchall():
+            if amt != asked:
+                logger.warning("order %s: received %s USDT, asked %s", oid, fmt_usd(amt), fmt_usd(asked))
+            if conn.execute(SQL_MARK_PAID, (oid,)).rowcount:
+                credited[uid] = credited.get(uid, 0) + amt
+        for uid, cents in credited.items():
+            balance_cache[uid] = conn.execute(SQL_UPSERT_BALANCE, (uid, cents)).fetchone()[0]
+    return credited
+
+async def poll_tron_payments(context: CallbackContext):
+    rows     = await fetch_tron_payments()
+    credited = await asyncio.to_thread(settle_payments, rows)
+    # Tell the payers now instead of waiting for them to /check
+    for uid, cents in credited.items():
+        try:
+            await context.bot.send_message(uid, f"✅ Received {fmt_usd(cents)} USDT; balance credited.")
+        except Exception as e:
+            logger.error(f"payment notice to {uid} failed: {e}")
 
 # === OPEN API WRAPPERS ===
 
 @ttl_cache(ttl_seconds=3600)
-def fetch_packages(location_code: str=None) -> list[dict]:
-    url     = "https://api.esimaccess.com/api/v1/open/package/list"
+async def fetch_packages(location_code: str=None) -> list[dict]:
+    url     = ESIM_PACKAGE_LIST_URL
     payload = {"type": "BASE"}
     if location_code:
         payload["locationCode"] = location_code
     try:
-        r = requests.post(url, headers=COMMON_HEADERS, json=payload, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        r = await http_request(
+            esim_breaker, "POST", url,
+            headers=COMMON_HEADERS, json=payload,
+            timeout=httpx.Timeout(10.0, connect=1.0)
+        )
+        data = orjson.loads(r.content)
         logger.info("BASE-list raw response: %s", data)
         if not data.get("success", False):
             return []
@@ -151,18 +679,21 @@ def fetch_packages(location_code: str=None) -> list[dict]:
     return []
 
 @ttl_cache(ttl_seconds=3600)
-def fetch_topup_packages(package_code: str=None,
+async def fetch_topup_packages(package_code: str=None,
                          slug: str=None,
                          iccid: str=None) -> list[dict]:
-    url     = "https://api.esimaccess.com/api/v1/open/package/list"
+    url     = ESIM_PACKAGE_LIST_URL
     payload = {"type": "TOPUP"}
     if package_code: payload["packageCode"] = package_code
     if slug:         payload["slug"]        = slug
     if iccid:        payload["iccid"]       = iccid
     try:
-        r = requests.post(url, headers=COMMON_HEADERS, json=payload, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        r = await http_request(
+            esim_breaker, "POST", url,
+            headers=COMMON_HEADERS, json=payload,
+            timeout=httpx.Timeout(10.0, connect=1.0)
+        )
+        data = orjson.loads(r.content)
         logger.info("TOPUP-list raw response: %s", data)
         if not data.get("success", False):
             return []
@@ -178,9 +709,43 @@ def fetch_topup_packages(package_code: str=None,
         logger.error(f"fetch_topup_packages error: {e}")
     return []
 
-def order_esim_open(memo: str, pkg_code: str, price_usd: float) -> str|None:
-    url       = "https://api.esimaccess.com/api/v1/open/esim/order"
-    amt_units = int(price_usd * 10000)
+def plan_row(p: dict) -> tuple[str, str, int]:
+    """(code, button label, price in cents) for one package."""
+    code   = p.get("packageCode") or p.get("slug")
+    cents  = p.get("price",0)//100
+    vol_GB = p.get("volume",0)/(1024**3)
+    dur    = p.get("duration",0)
+    unit   = p.get("durationUnit","DAY")
+    return code, f"{code}: {vol_GB:.1f} GB · {dur}{unit} — ${fmt_usd(cents)}", cents
+
+@ttl_cache(ttl_seconds=3600)
+async def plan_index() -> dict[str, dict[str, tuple[str, list[tuple[str, str, int]]]]]:
+    """Menu tree {continent: {country code: (name, plans sorted by price)}}."""
+    index = {}
+    for p in await fetch_packages():
+        row = plan_row(p)
+        for loc in p.get("locationNetworkList", []):
+            cc        = loc["locationCode"]
+            countries = index.setdefault(country_to_continent(cc), {})
+            countries.setdefault(cc, (loc["locationName"], []))[1].append(row)
+    for countries in index.values():
+        for _, plans in countries.values():
+            plans.sort(key=lambda r: r[2])
+    return index
+
+class OrderStatusUnknown(Exception):
+    """The order request may have reached esimaccess; whether it was placed is unknown."""
+
+# Failures that mean the order request never reached esimaccess
+ORDER_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+async def order_esim_open(memo: str, pkg_code: str, price_cents: int) -> str|None:
+    """Place an order; None if it definitely wasn't placed.
+
+    Raises OrderStatusUnknown when it may have been (timeouts, 5xx, bad replies).
+    """
+    url       = ESIM_ORDER_URL
+    amt_units = price_cents * 100  # API prices are in 1/10000 USD
     payload   = {
         "transactionId": memo,
         "amount":        amt_units,
@@ -191,178 +756,348 @@ def order_esim_open(memo: str, pkg_code: str, price_usd: float) -> str|None:
         }]
     }
     try:
-        r = requests.post(url, headers=COMMON_HEADERS, json=payload, timeout=15)
-        r.raise_for_status()
-        d = r.json()
-        if d.get("success"):
-            return d["obj"].get("orderNo")
-        logger.error("order_esim_open failed: %s", d)
+        # Only retry when the order cannot have reached the server
+        r = await http_request(
+            esim_breaker, "POST", url,
+            retry_on=ORDER_NOT_SENT,
+            headers=COMMON_HEADERS, json=payload,
+            timeout=httpx.Timeout(15.0, connect=1.0)
+        )
+        d = orjson.loads(r.content)
+    except (CircuitOpenError, *ORDER_NOT_SENT) as e:
+        logger.error(f"order_esim_open not sent: {e!r}")
+        return None
     except Exception as e:
-        logger.error(f"order_esim_open error: {e}")
-    return None
+        raise OrderStatusUnknown(repr(e)) from e
+    if not d.get("success"):
+        logger.error("order_esim_open failed: %s", d)
+        return None
+    order_no = (d.get("obj") or {}).get("orderNo")
+    if not order_no:
+        raise OrderStatusUnknown(f"success without orderNo: {d}")
+    return order_no
 
-def query_esim_open(order_no: str=None, iccid: str=None) -> list[dict]:
-    url     = "https://api.esimaccess.com/api/v1/open/esim/query"
+async def query_esim_open(order_no: str=None, iccid: str=None) -> list[dict]:
+    url     = ESIM_QUERY_URL
     payload = {"pager": {"pageNum": 1, "pageSize": 20}}
     if order_no: payload["orderNo"] = order_no
     if iccid:    payload["iccid"]    = iccid
     try:
-        r = requests.post(url, headers=COMMON_HEADERS, json=payload, timeout=10)
-        r.raise_for_status()
-        return r.json().get("obj", {}).get("esimList", [])
+        r = await http_request(
+            esim_breaker, "POST", url,
+            headers=COMMON_HEADERS, json=payload,
+            timeout=httpx.Timeout(10.0, connect=1.0)
+        )
+        return orjson.loads(r.content).get("obj", {}).get("esimList", [])
     except Exception as e:
         logger.error(f"query_esim_open error: {e}")
     return []
 
+# === PREBUILT KEYBOARDS ===
+# Rebuilt only when the package TTL window rolls over, not per click
+
+# Purchase buttons carry a small id instead of "<code>_<cents>". Ids live in the
+# choices table, keyed by (code, charged cents), so they survive restarts and
+# refreshes reuse them; memory mirrors the table in both directions.
+with pool.acquire() as _conn:
+    _choices: dict[int, tuple[str, int]] = {
+        cid: (code, cents) for cid, code, cents in _conn.execute(SQL_ALL_CHOICES)
+    }
+_choice_ids: dict[tuple[str, int], int] = {key: cid for cid, key in _choices.items()}
+
+def choice_id(code: str, cents: int) -> int:
+    key = (code, max(cents, MIN_ORDER_CENTS))
+    cid = _choice_ids.get(key)
+    if cid is None:
+        with pool.write() as conn:
+            cid = conn.execute(SQL_UPSERT_CHOICE, key).fetchone()[0]
+        _choice_ids[key] = cid
+        _choices[cid]    = key
+    return cid
+
+def plan_markup(rows: list[tuple[str, str, int]]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=f"PKG_{choice_id(code, cents)}")]
+        for code, label, cents in rows
+    ])
+
+@ttl_cache(ttl_seconds=3600)
+async def plan_menus() -> dict:
+    """Continent keyboard, country keyboard per continent, plan keyboard per country."""
+    index = await plan_index()
+    continents = InlineKeyboardMarkup([
+        [InlineKeyboardButton(cont, callback_data=f"CONT_{cont}")]
+        for cont in sorted(index)
+    ]) if index else None
+    countries = {
+        cont: InlineKeyboardMarkup([
+            [InlineKeyboardButton(name, callback_data=f"REG_{cc}")]
+            for cc, (name, _) in sorted(by_code.items(), key=lambda x: x[1][0])
+        ])
+        for cont, by_code in index.items()
+    }
+    plans = {
+        cc: plan_markup(rows)
+        for by_code in index.values()
+        for cc, (_, rows) in by_code.items()
+    }
+    return {"continents": continents, "countries": countries, "plans": plans}
+
+def parse_plan_callback(data: str) -> tuple[str, int] | None:
+    """Resolve 'PREFIX_<id>' to (code, cents); None for an unknown id."""
+    _, _, rest = data.partition("_")
+    return _choices.get(int(rest)) if rest.isdigit() else None
+
+# === BACKGROUND JOBS ===
+PLANS_REFRESH_INTERVAL = 600  # seconds; well inside the 1h package TTL
+PACKAGES_TTL           = 3600  # fetch_packages' cache TTL
+# Last good package list, so a restart serves menus without waiting on esimaccess
+PACKAGES_SNAPSHOT      = "packages_cache.json"
+SNAPSHOT_VERSION       = 1
+
+def load_packages_snapshot() -> float | None:
+    """Prime fetch_packages from disk; returns the snapshot's age, or None if unusable."""
+    try:
+        with open(PACKAGES_SNAPSHOT, "rb") as f:
+            snap = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    age = time.time() - snap.get("saved", 0)
+    if snap.get("v") != SNAPSHOT_VERSION or not snap.get("packages") or not 0 <= age < PACKAGES_TTL:
+        return None
+    fetch_packages.prime(snap["packages"], age=age)
+    return age
+
+def save_packages_snapshot(pkgs: list[dict]):
+    tmp = PACKAGES_SNAPSHOT + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps({"v": SNAPSHOT_VERSION, "saved": time.time(), "packages": pkgs}))
+    os.replace(tmp, PACKAGES_SNAPSHOT)
+
+async def refresh_plans(context: CallbackContext):
+    """Rebuild the catalog out-of-band so handlers never wait on esimaccess."""
+    # An empty fetch leaves the last good menus (and snapshot) in place
+    pkgs = await fetch_packages.refresh()
+    if pkgs:
+        await plan_index.refresh()
+        await plan_menus.refresh()
+        await asyncio.to_thread(save_packages_snapshot, pkgs)
+
+DB_OPTIMIZE_INTERVAL = 6 * 3600  # seconds
+
+def _optimize_db():
+    with pool.write() as conn:
+        conn.execute("PRAGMA optimize")
+
+async def optimize_db(context: CallbackContext):
+    """Let SQLite refresh planner statistics for the orders indexes."""
+    await asyncio.to_thread(_optimize_db)
+
+# === PURCHASE QUEUE ===
+# Handlers debit and ack right away; workers place the order, then hand profile
+# polling to its own task so a slow allocation doesn't hold up the next order
+PURCHASE_WORKERS      = 4
+PROFILE_POLL_ATTEMPTS = 9
+PROFILE_POLL_INITIAL  = 0.5  # seconds; doubles per attempt up to the cap (39.5s of sleeps)
+PROFILE_POLL_CAP      = 8.0
+purchase_jobs: asyncio.Queue = asyncio.Queue()
+
+async def place_order(application, job: dict):
+    msg, label = job["message"], job["label"]
+    memo     = generate_memo()
+    try:
+        order_no = await order_esim_open(memo, job["code"], job["price"])
+    except OrderStatusUnknown as e:
+        # esimaccess may have billed this one; keep the debit and leave it to an admin
+        logger.error(f"order {memo} for {job['user_id']} needs reconciling: {e}")
+        with pool.write() as conn:
+            conn.execute(SQL_FLAG_UNCERTAIN,
+                         (memo, job["user_id"], job["code"], job["price"], str(e)))
+        return await msg.reply_text(
+            f"⚠️ {label} status unknown; we're checking it with the provider. Reference: {memo}"
+        )
+    if not order_no:
+        # Nothing was placed, so the up-front debit goes back
+        credit_balance(job["user_id"], job["price"])
+        return await msg.reply_text(
+            f"❌ {label} failed; {fmt_usd(job['price'])} USDT returned to your balance—please retry."
+        )
+    with pool.write() as conn:
+        # Attach the order number to the deposit that paid for it, if there is one;
+        # purchases from an already-funded balance get a row of their own
+        if not conn.execute(SQL_UPDATE_ORDER_PAID,
+                            (order_no, job["user_id"], job["code"])).rowcount:
+            conn.execute(SQL_INSERT_SALE, (job["user_id"], job["username"], job["price"] / 100,
+                                           memo, job["code"], order_no))
+        conn.execute(SQL_COUNT_SALE, (job["price"] / 100,))
+    await msg.reply_text(f"⏳ {label} {order_no} placed; provisioning—I'll send the QR here.")
+    application.create_task(deliver_profiles(msg, label, order_no))
+
+async def deliver_profiles(msg, label: str, order_no: str):
+    profiles = []
+    for k in range(PROFILE_POLL_ATTEMPTS):
+        if k:
+            await asyncio.sleep(min(PROFILE_POLL_INITIAL * 2 ** (k - 1), PROFILE_POLL_CAP))
+        profiles = await query_esim_open(order_no=order_no)
+        if profiles:
+            break
+    if not profiles:
+        return await msg.reply_text(f"⏳ {label} {order_no}: profiles still pending. Use /check.")
+    for p in profiles:
+        qr = p.get("qrCodeUrl") or p.get("ac")
+        await msg.reply_photo(photo=await send_qr_code(qr), caption=qr)
+
+async def purchase_worker(application):
+    while True:
+        job = await purchase_jobs.get()
+        try:
+            await place_order(application, job)
+        except Exception as e:
+            logger.error(f"purchase_worker error: {e}")
+        finally:
+            purchase_jobs.task_done()
+
+# === PER-USER THROTTLE ===
+# Token bucket per user: bursts of USER_BURST, refilled at USER_RATE per second
+USER_BURST            = 5
+USER_RATE             = 0.5  # 30 updates/minute
+THROTTLE_PRUNE_PERIOD = 60   # seconds
+# user id -> (tokens, last update, already told to slow down)
+_user_buckets: dict[int, tuple[float, float, bool]] = {}
+
+async def throttle(update: Update, context: CallbackContext):
+    """Runs before every handler; stops the update if its sender is over budget."""
+    user = update.effective_user
+    if user is None or user.id in ADMIN_IDS:
+        return
+    now                  = time.monotonic()
+    tokens, last, warned = _user_buckets.get(user.id, (USER_BURST, now, False))
+    tokens               = min(USER_BURST, tokens + (now - last) * USER_RATE)
+    if tokens >= 1:
+        _user_buckets[user.id] = (tokens - 1, now, False)
+        return
+    _user_buckets[user.id] = (tokens, now, True)
+    # One notice per refill; further spam is dropped without a chat message.
+    # Button presses are still answered (silently) so the client stops spinning.
+    msg = None if warned else f"⏳ Too many requests; try again in {int((1 - tokens) / USER_RATE) + 1}s."
+    if update.callback_query:
+        await update.callback_query.answer(msg)
+    elif msg and update.effective_message:
+        await update.effective_message.reply_text(msg)
+    raise ApplicationHandlerStop
+
+async def prune_throttle(context: CallbackContext):
+    """Forget buckets that have refilled; a fresh one is identical."""
+    now = time.monotonic()
+    for uid, (tokens, last, _) in list(_user_buckets.items()):
+        if tokens + (now - last) * USER_RATE >= USER_BURST:
+            del _user_buckets[uid]
+
 # === BOT COMMAND HANDLERS ===
 
+HELP_TEXT = (
+    "\U0001F4D6 *eSIM Bot Help*\n\n"
+    "*/start* – Main menu\n"
+    "*/balance* – Your USDT balance\n"
+    "*/browse* – Browse BASE plans (continent→country→plan)\n"
+    "*/topuplans [code]* – Browse TOPUP plans\n"
+    "*/queryorder <orderNo>* – Fetch profiles by orderNo\n"
+    "*/queryiccid <iccid>* – Fetch profiles by ICCID\n"
+    "*/check* – Check last order status\n"
+    "*/topup <amount>* – Request a top-up\n"
+    "*/topup <user_id> <amt> …* – Credit users (admin)\n"
+    "*/admin* – Sales stats (admin only)\n"
+)
+
+_USER_BUTTONS = [
+    [KeyboardButton("📦 Browse"), KeyboardButton("💰 Balance")],
+    [KeyboardButton("⭮ TopUpPlans"), KeyboardButton("✅ Check")],
+    [KeyboardButton("📖 Help")]
+]
+_ADMIN_BUTTONS = [
+    _USER_BUTTONS[0],
+    _USER_BUTTONS[1] + [KeyboardButton("➕ Topup"), KeyboardButton("📊 Admin")],
+    _USER_BUTTONS[2]
+]
+USER_MENU  = ReplyKeyboardMarkup(_USER_BUTTONS,  resize_keyboard=True)
+ADMIN_MENU = ReplyKeyboardMarkup(_ADMIN_BUTTONS, resize_keyboard=True)
+
 async def help_cmd(update: Update, context: CallbackContext):
-    await update.message.reply_text(
-        "\U0001F4D6 *eSIM Bot Help*\n\n"
-        "*/start* – Main menu\n"
-        "*/balance* – Your USDT balance\n"
-        "*/browse* – Browse BASE plans (continent→country→plan)\n"
-        "*/topuplans [code]* – Browse TOPUP plans\n"
-        "*/queryorder <orderNo>* – Fetch profiles by orderNo\n"
-        "*/queryiccid <iccid>* – Fetch profiles by ICCID\n"
-        "*/check* – Check last order status\n"
-        "*/topup <amount>* – Request a top-up\n"
-        "*/topup <user_id> <amt>* – Credit user (admin)\n"
-        "*/admin* – Sales stats (admin only)\n",
-        parse_mode="Markdown"
-    )
+    await update.message.reply_text(HELP_TEXT, parse_mode="Markdown")
 
 async def start(update: Update, context: CallbackContext):
-    uid = update.effective_user.id
-    kb = [
-        [KeyboardButton("📦 Browse"), KeyboardButton("💰 Balance")],
-        [KeyboardButton("⭮ TopUpPlans"), KeyboardButton("✅ Check")],
-        [KeyboardButton("📖 Help")]
-    ]
-    if uid in ADMIN_IDS:
-        kb[1].append(KeyboardButton("➕ Topup"))
-        kb[1].append(KeyboardButton("📊 Admin"))
-    await update.message.reply_text(
-        "Welcome! Use the menu below:",
-        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    )
+    menu = ADMIN_MENU if update.effective_user.id in ADMIN_IDS else USER_MENU
+    await update.message.reply_text("Welcome! Use the menu below:", reply_markup=menu)
 
 # Level 1: list continents
 async def browse(update: Update, context: CallbackContext):
-    pkgs = fetch_packages()
-    if not pkgs:
+    menus = await plan_menus()
+    if not menus["continents"]:
         return await update.message.reply_text("No plans at this time.")
-    codes = set()
-    for p in pkgs:
-        for loc in p.get("locationNetworkList", []):
-            codes.add(loc["locationCode"])
-    continents = {}
-    for cc in codes:
-        cont = country_to_continent(cc)
-        continents.setdefault(cont, []).append(cc)
-    buttons = [
-        [InlineKeyboardButton(cont, callback_data=f"CONT_{cont}")]
-        for cont in sorted(continents)
-    ]
     await update.message.reply_text(
         "🌍 Choose a continent:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=menus["continents"]
     )
 
 # Level 2: list countries in continent
 async def continent_selector(update: Update, context: CallbackContext):
     await update.callback_query.answer()
-    cont = update.callback_query.data.split("_",1)[1]
-    pkgs = fetch_packages()
-    code_to_name = {}
-    for p in pkgs:
-        for loc in p.get("locationNetworkList", []):
-            cc = loc["locationCode"]
-            if country_to_continent(cc) == cont:
-                code_to_name[cc] = loc["locationName"]
-    if not code_to_name:
+    cont   = update.callback_query.data.split("_",1)[1]
+    markup = (await plan_menus())["countries"].get(cont)
+    if not markup:
         return await update.callback_query.message.reply_text(f"No countries in {cont}.")
-    buttons = [
-        [InlineKeyboardButton(name, callback_data=f"REG_{cc}")]
-        for cc, name in sorted(code_to_name.items(), key=lambda x: x[1])
-    ]
     await update.callback_query.message.reply_text(
         f"🌎 Countries in {cont}:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=markup
     )
 
 # Level 3: list plans in country
 async def country_selector(update: Update, context: CallbackContext):
     await update.callback_query.answer()
     country = update.callback_query.data.split("_",1)[1]
-    pkgs    = fetch_packages(location_code=country)
-    if not pkgs:
+    markup  = (await plan_menus())["plans"].get(country)
+    if not markup:
+        # Only ask esimaccess directly when the full catalog has nothing for it
+        rows   = sorted(map(plan_row, await fetch_packages(location_code=country)),
+                        key=lambda r: r[2])
+        markup = plan_markup(rows) if rows else None
+    if not markup:
         return await update.callback_query.message.reply_text(f"No plans in {country}.")
-    buttons = []
-    for p in pkgs:
-        code      = p.get("packageCode") or p.get("slug")
-        price_usd = p.get("price",0)/10000
-        vol_GB    = p.get("volume",0)/(1024**3)
-        dur       = p.get("duration",0)
-        unit      = p.get("durationUnit","DAY")
-        label     = f"{code}: {vol_GB:.1f} GB · {dur}{unit} — ${price_usd:.2f}"
-        disp      = max(price_usd, 5.0)
-        buttons.append([InlineKeyboardButton(label, callback_data=f"PKG_{code}_{disp:.2f}")])
     await update.callback_query.message.reply_text(
         f"📡 Plans for {country}:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=markup
     )
 
 # Plan purchase handler
 async def pkg_handler(update: Update, context: CallbackContext):
     q   = update.callback_query; await q.answer()
-    _, code, price_s = q.data.split("_")
-    price_usd        = float(price_s)
-    uid              = q.from_user.id
-    if price_usd < 5.0:
+    choice = parse_plan_callback(q.data)
+    if choice is None:
+        return await q.message.reply_text("⌛ This menu has expired; please open it again.")
+    code, price = choice
+    uid         = q.from_user.id
+    if price < MIN_ORDER_CENTS:
         await q.message.reply_text("⚠️ Minimum 5 USDT; extra credited.")
-        price_usd = 5.0
-    c.execute("SELECT balance FROM balances WHERE user_id=?", (uid,))
-    row = c.fetchone(); bal = row[0] if row else 0.0
-    if bal < price_usd:
+        price = MIN_ORDER_CENTS
+    if esim_breaker.is_open():
+        return await q.message.reply_text("⏳ eSIM provider is busy; try again in a moment.")
+    if not debit_balance(uid, price):
         memo  = generate_memo()
         uname = q.from_user.username or str(uid)
-        c.execute(
-            "INSERT INTO orders (user_id,username,amount,memo,plan_id) VALUES(?,?,?,?,?)",
-            (uid, uname, price_usd, memo, code)
-        )
-        conn.commit()
+        with pool.write() as conn:
+            conn.execute(SQL_INSERT_ORDER, (uid, uname, price / 100, memo, code))
         txt = (
-            f"🔋 Top-up required\nSend *{price_usd:.2f} USDT* to `{WALLET_ADDRESS}`\n"
-            f"Memo: `{memo}`"
-        )
-        return await q.message.reply_photo(photo=send_qr_code(txt),
-                                           caption=txt, parse_mode="Markdown")
-    new_bal = bal - price_usd
-    c.execute("UPDATE balances SET balance=? WHERE user_id=?", (new_bal, uid))
-    conn.commit()
-    memo     = generate_memo()
-    order_no = order_esim_open(memo, code, price_usd)
-    if not order_no:
-        return await q.message.reply_text("❌ Order failed—please retry.")
-    c.execute("""
-      UPDATE orders SET memo=?,order_no=?,paid=1 
-      WHERE user_id=? AND plan_id=? AND paid=0
-    """, (memo, order_no, uid, code))
-    conn.commit()
-    profiles = []
-    for _ in range(15):
-        profiles = query_esim_open(order_no=order_no)
-        if profiles:
-            break
-        time.sleep(2)
-    if not profiles:
-        return await q.message.reply_text(
-            f"✔️ Order {order_no} placed; profiles pending. Use /check."
+            f"🔋 Top-up required\nSend *{fmt_usd(price)} USDT* to `{WALLET_ADDRESS}`\n"
+            f"Memo: `{memo}`\nPay within 24h."
         )
-    for p in profiles:
-        qr = p.get("qrCodeUrl") or p.get("ac")
-        await q.message.reply_photo(photo=send_qr_code(qr), caption=qr)
+        return await send_payment_request(q.message, txt)
+    # Queue before any other await so the debit always has a job behind it
+    purchase_jobs.put_nowait({
+        "message": q.message, "user_id": uid, "username": q.from_user.username or str(uid),
+        "code": code, "price": price, "label": "Order"
+    })
+    await context.bot.send_chat_action(q.message.chat_id, ChatAction.UPLOAD_PHOTO)
+    await q.message.reply_text("⏳ Processing…")
 
 # TOPUP plans command
 async def topuplans_cmd(update: Update, context: CallbackContext):
@@ -371,22 +1106,21 @@ async def topuplans_cmd(update: Update, context: CallbackContext):
         code = args[0]
     else:
         uid = update.message.from_user.id
-        c.execute("SELECT plan_id FROM orders WHERE user_id=? AND paid=1 ORDER BY id DESC LIMIT 1", (uid,))
-        row = c.fetchone()
+        with pool.acquire() as conn:
+            row = conn.execute(SQL_LAST_PLAN, (uid,)).fetchone()
         if not row:
             return await update.message.reply_text("No recent plan—please pass a packageCode.")
         code = row[0]
-    pkgs = fetch_topup_packages(package_code=code)
+    pkgs = await fetch_topup_packages(package_code=code)
     if not pkgs:
         return await update.message.reply_text(f"No top-up plans for {code}.")
     buttons = []
     for p in pkgs:
-        tp        = p.get("packageCode") or p.get("slug")
-        price_usd = p.get("price",0)/10000
-        disp      = max(price_usd, 5.0)
+        tp    = p.get("packageCode") or p.get("slug")
+        cents = p.get("price",0)//100
         buttons.append([InlineKeyboardButton(
-            f"{tp} — ${price_usd:.2f}",
-            callback_data=f"TPUP_{tp}_{disp:.2f}"
+            f"{tp} — ${fmt_usd(cents)}",
+            callback_data=f"TPUP_{choice_id(tp, cents)}"
         )])
     await update.message.reply_text(
         f"🔄 Top-up plans for {code}:",
@@ -396,130 +1130,109 @@ async def topuplans_cmd(update: Update, context: CallbackContext):
 # TOPUP plan handler
 async def topup_plan_handler(update: Update, context: CallbackContext):
     q   = update.callback_query; await q.answer()
-    _, code, price_s = q.data.split("_")
-    price_usd        = float(price_s)
-    uid              = q.from_user.id
-    if price_usd < 5.0:
+    choice = parse_plan_callback(q.data)
+    if choice is None:
+        return await q.message.reply_text("⌛ This menu has expired; please open it again.")
+    code, price = choice
+    uid         = q.from_user.id
+    if price < MIN_ORDER_CENTS:
         await q.message.reply_text("⚠️ Minimum 5 USDT; extra credited.")
-        price_usd = 5.0
-    c.execute("SELECT balance FROM balances WHERE user_id=?", (uid,))
-    row = c.fetchone(); bal = row[0] if row else 0.0
-    if bal < price_usd:
+        price = MIN_ORDER_CENTS
+    if esim_breaker.is_open():
+        return await q.message.reply_text("⏳ eSIM provider is busy; try again in a moment.")
+    if not debit_balance(uid, price):
         memo  = generate_memo()
         uname = q.from_user.username or str(uid)
-        c.execute(
-            "INSERT INTO orders (user_id,username,amount,memo,plan_id) VALUES(?,?,?,?,?)",
-            (uid, uname, price_usd, memo, code)
-        )
-        conn.commit()
+        with pool.write() as conn:
+            conn.execute(SQL_INSERT_ORDER, (uid, uname, price / 100, memo, code))
         txt = (
-            f"🔋 Top-up required\nSend *{price_usd:.2f} USDT* to `{WALLET_ADDRESS}`\n"
-            f"Memo: `{memo}`"
+            f"🔋 Top-up required\nSend *{fmt_usd(price)} USDT* to `{WALLET_ADDRESS}`\n"
+            f"Memo: `{memo}`\nPay within 24h."
         )
-        return await q.message.reply_photo(photo=send_qr_code(txt),
-                                           caption=txt, parse_mode="Markdown")
-    new_bal = bal - price_usd
-    c.execute("UPDATE balances SET balance=? WHERE user_id=?", (new_bal, uid))
-    conn.commit()
-    memo     = generate_memo()
-    order_no = order_esim_open(memo, code, price_usd)
-    if not order_no:
-        return await q.message.reply_text("❌ Top-up order failed.")
-    c.execute("""
-      UPDATE orders SET memo=?,order_no=?,paid=1 
-      WHERE user_id=? AND plan_id=? AND paid=0
-    """, (memo, order_no, uid, code))
-    conn.commit()
-    profiles = []
-    for _ in range(15):
-        profiles = query_esim_open(order_no=order_no)
-        if profiles:
-            break
-        time.sleep(2)
-    if not profiles:
-        return await q.message.reply_text(f"✔️ Top-up {order_no} placed; profiles pending.")
-    for p in profiles:
-        qr = p.get("qrCodeUrl") or p.get("ac")
-        await q.message.reply_photo(photo=send_qr_code(qr), caption=qr)
+        return await send_payment_request(q.message, txt)
+    # Queue before any other await so the debit always has a job behind it
+    purchase_jobs.put_nowait({
+        "message": q.message, "user_id": uid, "username": q.from_user.username or str(uid),
+        "code": code, "price": price, "label": "Top-up"
+    })
+    await context.bot.send_chat_action(q.message.chat_id, ChatAction.UPLOAD_PHOTO)
+    await q.message.reply_text("⏳ Processing…")
 
 # Query by orderNo
 async def query_order_cmd(update: Update, context: CallbackContext):
     args = context.args
     if len(args) != 1:
         return await update.message.reply_text("Usage: /queryorder <orderNo>")
-    profiles = query_esim_open(order_no=args[0])
+    profiles = await query_esim_open(order_no=args[0])
     if not profiles:
         return await update.message.reply_text(f"No profiles for order {args[0]} yet.")
     for p in profiles:
         qr = p.get("qrCodeUrl") or p.get("ac")
-        await update.message.reply_photo(photo=send_qr_code(qr), caption=qr)
+        await update.message.reply_photo(photo=await send_qr_code(qr), caption=qr)
 
 # Query by ICCID
 async def query_iccid_cmd(update: Update, context: CallbackContext):
     args = context.args
     if len(args) != 1:
         return await update.message.reply_text("Usage: /queryiccid <iccid>")
-    profiles = query_esim_open(iccid=args[0])
+    profiles = await query_esim_open(iccid=args[0])
     if not profiles:
         return await update.message.reply_text(f"No profiles for ICCID {args[0]}.")
     for p in profiles:
         qr = p.get("qrCodeUrl") or p.get("ac")
-        await update.message.reply_photo(photo=send_qr_code(qr), caption=qr)
+        await update.message.reply_photo(photo=await send_qr_code(qr), caption=qr)
 
 # Check last order
 async def check(update: Update, context: CallbackContext):
     uid = update.message.from_user.id
-    c.execute("""
-      SELECT order_no FROM orders
-      WHERE user_id=? AND paid=1 AND order_no IS NOT NULL
-      ORDER BY id DESC LIMIT 1
-    """, (uid,))
-    row = c.fetchone()
+    with pool.acquire() as conn:
+        row = conn.execute(SQL_LAST_ORDER_NO, (uid,)).fetchone()
     if not row:
         return await update.message.reply_text("No recent orders to check.")
-    profiles = query_esim_open(order_no=row[0])
+    profiles = await query_esim_open(order_no=row[0])
     if not profiles:
         return await update.message.reply_text("⏳ Still allocating; try again later.")
     for p in profiles:
         qr = p.get("qrCodeUrl") or p.get("ac")
-        await update.message.reply_photo(photo=send_qr_code(qr), caption=qr)
+        await update.message.reply_photo(photo=await send_qr_code(qr), caption=qr)
 
 # View balance
 async def balance(update: Update, context: CallbackContext):
     uid = update.message.from_user.id
-    c.execute("SELECT balance FROM balances WHERE user_id=?", (uid,))
-    row = c.fetchone(); bal = row[0] if row else 0.0
-    await update.message.reply_text(f"💰 Balance: {bal:.2f} USDT\n👤 Your ID: {uid}")
+    bal = get_balance(uid)
+    await update.message.reply_text(f"💰 Balance: {fmt_usd(bal)} USDT\n👤 Your ID: {uid}")
 
 # Request or credit top-up
 async def topup(update: Update, context: CallbackContext):
     uid  = update.message.from_user.id
     args = context.args
-    if uid in ADMIN_IDS and len(args) == 2:
-        tgt, amt = args[0], float(args[1])
-        c.execute(
-            "INSERT INTO balances(user_id,balance) VALUES(?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET balance=balance+?",
-            (tgt, amt, amt)
+    usage = "Usage: /topup <amount>" if uid not in ADMIN_IDS else "Usage: /topup <user_id> <amount> [...]"
+    if uid in ADMIN_IDS and len(args) >= 2 and len(args) % 2 == 0:
+        rows = [
+            (int(tgt) if tgt.isdigit() else None, parse_usd(amt))
+            for tgt, amt in zip(args[::2], args[1::2])
+        ]
+        if any(tgt is None or amt is None for tgt, amt in rows):
+            return await update.message.reply_text(usage)
+        with pool.write() as conn:
+            for tgt, amt in rows:
+                balance_cache[tgt] = conn.execute(SQL_UPSERT_BALANCE, (tgt, amt)).fetchone()[0]
+        return await update.message.reply_text(
+            "\n".join(f"✅ Credited {fmt_usd(amt)} USDT to {tgt}." for tgt, amt in rows)
         )
-        conn.commit()
-        return await update.message.reply_text(f"✅ Credited {amt:.2f} USDT to {tgt}.")
     if len(args) == 1:
-        amt   = float(args[0])
+        amt   = parse_usd(args[0])
+        if amt is None:
+            return await update.message.reply_text(usage)
         memo  = generate_memo()
         uname = update.message.from_user.username or str(uid)
-        c.execute(
-            "INSERT INTO orders (user_id,username,amount,memo,plan_id) VALUES(?,?,?,?,?)",
-            (uid, uname, amt, memo, "TOPUP")
-        )
-        conn.commit()
+        with pool.write() as conn:
+            conn.execute(SQL_INSERT_ORDER, (uid, uname, amt / 100, memo, "TOPUP"))
         txt = (
-            f"🔋 Top-Up Request\nSend *{amt:.2f} USDT* to `{WALLET_ADDRESS}`\n"
-            f"Memo: `{memo}`"
+            f"🔋 Top-Up Request\nSend *{fmt_usd(amt)} USDT* to `{WALLET_ADDRESS}`\n"
+            f"Memo: `{memo}`\nPay within 24h."
         )
-        return await update.message.reply_photo(photo=send_qr_code(txt),
-                                                caption=txt, parse_mode="Markdown")
-    usage = "Usage: /topup <amount>" if uid not in ADMIN_IDS else "Usage: /topup <user_id> <amount>"
+        return await send_payment_request(update.message, txt)
     await update.message.reply_text(usage)
 
 # Admin stats
@@ -527,43 +1240,90 @@ async def admin(update: Update, context: CallbackContext):
     uid = update.message.from_user.id
     if uid not in ADMIN_IDS:
         return await update.message.reply_text("Unauthorized.")
-    c.execute("SELECT COUNT(*), SUM(amount) FROM orders WHERE paid=1")
-    sold, rev = c.fetchone()
-    c.execute("SELECT COUNT(DISTINCT user_id) FROM orders")
-    users = c.fetchone()[0]
+    with pool.acquire() as conn:
+        sold, rev, users = conn.execute(SQL_SALES_REPORT).fetchone()
+        uncertain,       = conn.execute(SQL_NUM_UNCERTAIN).fetchone()
     await update.message.reply_text(
         f"📊 Sales Report:\n"
         f"- Sold: {sold}\n"
         f"- Revenue: ${rev or 0:.2f}\n"
-        f"- Active users: {users}"
+        f"- Active users: {users}\n"
+        f"- Orders to reconcile: {uncertain}"
     )
 
+# Inline-button router: one dict lookup on the prefix instead of a regex per handler
+CALLBACK_ROUTES = {
+    "CONT": continent_selector,
+    "REG":  country_selector,
+    "PKG":  pkg_handler,
+    "TPUP": topup_plan_handler,
+}
+
+async def route_callback(update: Update, context: CallbackContext):
+    handler = CALLBACK_ROUTES.get(update.callback_query.data.partition("_")[0])
+    if handler is None:
+        return await update.callback_query.answer()
+    await handler(update, context)
+
 # Main-menu text handler
+async def topup_hint(update: Update, context: CallbackContext):
+    await update.message.reply_text(
+        "Use `/topup <user_id> <amount>`",
+        parse_mode="Markdown"
+    )
+
+MENU_ROUTES = {
+    "📦 Browse":     browse,
+    "⭮ TopUpPlans": topuplans_cmd,
+    "💰 Balance":    balance,
+    "✅ Check":      check,
+    "📖 Help":       help_cmd,
+}
+ADMIN_MENU_ROUTES = {
+    "➕ Topup":      topup_hint,
+    "📊 Admin":      admin,
+}
+
 async def handle_main_menu(update: Update, context: CallbackContext):
     txt, uid = update.message.text, update.message.from_user.id
-    if txt == "📦 Browse":
-        return await browse(update, context)
-    if txt == "⭮ TopUpPlans":
-        return await topuplans_cmd(update, context)
-    if txt == "💰 Balance":
-        return await balance(update, context)
-    if txt == "✅ Check":
-        return await check(update, context)
-    if txt == "📖 Help":
-        return await help_cmd(update, context)
-    if txt == "➕ Topup" and uid in ADMIN_IDS:
-        return await update.message.reply_text(
-            "Use `/topup <user_id> <amount>`",
-            parse_mode="Markdown"
-        )
-    if txt == "📊 Admin" and uid in ADMIN_IDS:
-        return await admin(update, context)
-    await update.message.reply_text("Unknown option. Use /help.")
+    handler  = MENU_ROUTES.get(txt)
+    if handler is None and uid in ADMIN_IDS:
+        handler = ADMIN_MENU_ROUTES.get(txt)
+    if handler is None:
+        return await update.message.reply_text("Unknown option. Use /help.")
+    await handler(update, context)
 
 # === SETUP & RUN ===
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+app = (
+    ApplicationBuilder()
+    .token(TELEGRAM_TOKEN)
+    # Stay under Telegram's flood limits; if one still slips through, every
+    # request pauses for retry_after before the send is retried
+    .rate_limiter(AIORateLimiter(
+        overall_max_rate=28, overall_time_period=1,
+        group_max_rate=18,   group_time_period=60,
+        max_retries=3
+    ))
+    .post_init(_post_init)
+    .post_shutdown(_post_shutdown)
+    .build()
+)
+
+# Background jobs
+# A fresh on-disk snapshot pushes the first catalog fetch back to when it's due
+_snapshot_age = load_packages_snapshot()
+app.job_queue.run_repeating(
+    refresh_plans, interval=PLANS_REFRESH_INTERVAL,
+    first=0 if _snapshot_age is None else max(0, PLANS_REFRESH_INTERVAL - _snapshot_age)
+)
+app.job_queue.run_repeating(poll_tron_payments, interval=TRON_POLL_INTERVAL, first=1)
+app.job_queue.run_repeating(optimize_db, interval=DB_OPTIMIZE_INTERVAL, first=DB_OPTIMIZE_INTERVAL)
+app.job_queue.run_repeating(prune_throttle, interval=THROTTLE_PRUNE_PERIOD, first=THROTTLE_PRUNE_PERIOD)
 
 # Command handlers
+# Per-user throttle runs first, in its own group
+app.add_handler(TypeHandler(Update, throttle), group=-1)
+
 app.add_handler(CommandHandler("start",      start))
 app.add_handler(CommandHandler("help",       help_cmd))
 app.add_handler(CommandHandler("balance",    balance))
@@ -576,10 +1336,7 @@ app.add_handler(CommandHandler("topup",      topup))
 app.add_handler(CommandHandler("admin",      admin))
 
 # Callback handlers
-app.add_handler(CallbackQueryHandler(continent_selector, pattern="^CONT_"))
-app.add_handler(CallbackQueryHandler(country_selector,   pattern="^REG_"))
-app.add_handler(CallbackQueryHandler(pkg_handler,        pattern="^PKG_"))
-app.add_handler(CallbackQueryHandler(topup_plan_handler, pattern="^TPUP_"))
+app.add_handler(CallbackQueryHandler(route_callback))
 
 # Main-menu text fallback
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu))